@@ -1,9 +1,23 @@
 import streamlit as st 
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+from concurrent.futures import ProcessPoolExecutor
 import io
+import os
+import tempfile
+from pypdf import PdfWriter
+
+from plotting import cross_section_geometry, figure_to_pdf, render_pages_pdf
+
+# Prefer the Rust-backed calamine reader; fall back to openpyxl when python-calamine isn't installed
+try:
+    import python_calamine  # noqa: F401
+    excel_engine = "calamine"
+except ImportError:
+    excel_engine = "openpyxl"
 
 st.set_page_config(layout="wide")
 st.title("📊 Earthwork Excavation Cross-Section Plotter")
@@ -55,117 +69,116 @@ if use_manual_summary:
     manual_summary["Agreement Date"] = st.date_input("Agreement Date")
     manual_summary["Completion Date"] = st.date_input("Expected Completion Date")
 
-# 🖼 Plotting function
-def plot_chainage_subplot(entry, ax):
-    chainage = entry['Chainage']
-    fw = entry['Finished Roadway Width']
-    fh = entry['Finished Vertical Height']
-    ow = entry['Original Roadway Width']
-    ac = entry['Area Coefficient']
-    angle_deg = entry['Cutting slope']
-
-    try:
-        angle_deg = float(angle_deg) if pd.notna(angle_deg) else 75
-        if angle_deg == 0:
-            raise ValueError("Angle cannot be zero.")
-        slope = 1 / np.tan(np.radians(angle_deg))
-    except:
-        return
-
-    h1_coef = (ac - 0.5) * 2
+# 🗃 Cached loaders (keyed on the uploaded bytes, so reruns skip the Excel parse; bounded like build_report)
+expected_columns = [
+    "S.No", "Chainage", "Finished Roadway Width", "Finished Vertical Height",
+    "Original Roadway Width", "Area Coefficient", "Cutting slope"
+]
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_input(file_bytes):
+    # Single pass: locate the "Chainage" header row, then keep the rows below it
+    raw = pd.read_excel(io.BytesIO(file_bytes), header=None, engine=excel_engine)
+    probe = raw.head(50)
+    # One plain-substring scan per column rather than a Python lambda per row
+    is_header = np.zeros(len(probe), dtype=bool)
+    for col in probe.columns:
+        is_header |= probe[col].astype(str).str.contains("Chainage", case=False, na=False, regex=False).to_numpy()
+    if not is_header.any():
+        raise ValueError("No 'Chainage' header row found in the first 50 rows.")
+    header_row_index = probe.index[is_header.argmax()]
+
+    data = raw.iloc[header_row_index + 1:, :7].infer_objects()
+    data.columns = expected_columns
+    data.dropna(subset=[data.columns[0]], inplace=True)
+    if data.empty:
+        raise ValueError("No data rows found below the 'Chainage' header row.")
+
+    # Area and Volume Calculation
+    ac = data['Area Coefficient'].to_numpy(float)
+    fw = data['Finished Roadway Width'].to_numpy(float)
+    ow = data['Original Roadway Width'].to_numpy(float)
+    fh = data['Finished Vertical Height'].to_numpy(float)
     area = ac * (fw - ow) * fh
-
-    x1 = -fw / 2
-    x3 = fw / 2
-    x4 = fw / 2 + slope * fh
-    x6 = x1 + ow
-    x7 = x6 + h1_coef * fh * slope
-
-    fg_x = [x1, 0, x3, x4]
-    fg_y = [0, 0, 0, fh]
-    og_x = [x1, x6, x7, x4]
-    og_y = [0, 0, h1_coef * fh, fh]
-
-          # Plot lines
-    ax.plot(fg_x, fg_y, color="green", linewidth=2, label=f"Finished Roadway Width(FR): {fw:.2f} m")
-    ax.plot(og_x, og_y, color="red", linestyle="--", linewidth=2, label=f"Original Roadway Width(OR): {ow:.2f} m")
-    ax.fill(og_x + fg_x[::-1], og_y + fg_y[::-1], facecolor='gray', alpha=0.3, hatch='//', edgecolor='black')
-
-    # Add area as a text label inside plot
-    ax.text((x3 + x7)/2, (fh + h1_coef * fh)/2, f"Area = {area:.2f} m²", fontsize=8, ha='center')
-
-    # Draw horizontal axis
-    ax.axhline(0, color='black', linestyle=':')
-
-    # Add custom height label in legend
-    height_proxy = plt.Line2D([0], [0], color='white', label=f"Height: {fh:.2f} m")
-    handles, labels = ax.get_legend_handles_labels()
-    ax.legend(handles + [height_proxy], labels + [height_proxy.get_label()], fontsize=6, loc='upper left')
-
-
-
-    try:
-        ch_int = int(float(chainage))
-        km = ch_int // 1000
-        m = ch_int % 1000
-        chainage_str = f"{km}+{m:03d}"
-    except:
-        chainage_str = str(chainage)
-
-    ax.set_title(f"Chainage {chainage_str}", fontsize=9)
-    ax.set_xlabel("Roadway Width", fontsize=6)
-    ax.set_ylabel("Height", fontsize=6)
-    ax.grid(True, linestyle='--', linewidth=0.3)
-
-# ✅ Main Generate Button
-if data_file and st.button("📊 Generate Cross Section Plots"):
-    try:
-        # Step 1: Read data
-        raw = pd.read_excel(data_file, header=None, nrows=50)
-        header_row_index = raw[raw.apply(lambda row: row.astype(str).str.contains("Chainage", case=False).any(), axis=1)].index[0]
-        data = pd.read_excel(data_file, skiprows=header_row_index)
-        data.dropna(subset=[data.columns[0]], inplace=True)
-
-        expected_columns = [
-            "S.No", "Chainage", "Finished Roadway Width", "Finished Vertical Height",
-            "Original Roadway Width", "Area Coefficient", "Cutting slope"
-        ]
-        data = data.iloc[:, :7]
-        data.columns = expected_columns
-
-        # Step 2: Area and Volume Calculation
-        data['Area (m²)'] = data.apply(
-            lambda row: row['Area Coefficient'] * (row['Finished Roadway Width'] - row['Original Roadway Width']) * row['Finished Vertical Height'], axis=1
-        )
-        chainage_values = data['Chainage'].astype(str).str.replace("+", "").astype(float).values
-
-        volume_list = [0.0]
-        for i in range(1, len(data)):
-            ch1, ch2 = chainage_values[i - 1], chainage_values[i]
-            a1, a2 = data.at[i - 1, 'Area (m²)'], data.at[i, 'Area (m²)']
-            vol = ((a1 + a2) / 2) * (ch2 - ch1)
-            volume_list.append(vol)
-
-        data['Volume (m³)'] = volume_list
-
-        # Step 3: Contract Info
-        contract_no = contract_no_input
-        if summary_file:
-            summary_df = pd.read_excel(summary_file, header=None, nrows=10)
-            for row in summary_df.itertuples(index=False):
-                for i, val in enumerate(row):
-                    if isinstance(val, str) and "contract" in val.lower() and "identification" in val.lower():
-                        contract_no = str(row[i + 1]) if i + 1 < len(row) else contract_no
-                        break
-
-        # Step 4: PDF Plot Generation
-        pdf_buffer = io.BytesIO()
-        pdf = PdfPages(pdf_buffer)
-
-        if summary_file or use_manual_summary:
-            fig_summary, ax_summary = plt.subplots(figsize=(11.7, 8.3))
+    data['Area (m²)'] = area
+
+    # Chainage is usually numeric metres; only "km+m" text (e.g. "1+020") needs string handling
+    chainage = data['Chainage']
+    if pd.api.types.is_numeric_dtype(chainage):
+        chainage_values = chainage.to_numpy(float)
+    else:
+        parts = chainage.astype(str).str.split("+", n=1, expand=True)
+        km_or_m = parts[0].astype(float).to_numpy()
+        if parts.shape[1] == 1:
+            chainage_values = km_or_m
+        else:
+            metres = parts[1].astype(float).to_numpy()
+            chainage_values = np.where(np.isnan(metres), km_or_m, km_or_m * 1000 + metres)
+
+    # Average end area: volume between consecutive chainages
+    volume = np.empty_like(area)
+    volume[:1] = 0.0
+    volume[1:] = (area[:-1] + area[1:]) / 2 * np.diff(chainage_values)
+    data['Volume (m³)'] = volume
+    return data
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_summary(file_bytes):
+    return pd.read_excel(io.BytesIO(file_bytes), header=None, nrows=10, engine=excel_engine)
+
+# The contract number sits in the cell right of the first "Contract Identification" label
+@st.cache_data(show_spinner=False, max_entries=4)
+def find_contract_no(file_bytes):
+    summary_df = load_summary(file_bytes)
+    # Both words in either order, as in "Contract Identification No" or "Identification No. of Contract"
+    is_label = summary_df.astype(str).apply(
+        lambda col: col.str.contains("contract", case=False, regex=False)
+        & col.str.contains("identification", case=False, regex=False)
+    ).to_numpy()
+    hits = np.argwhere(is_label)
+    if len(hits) and hits[0][1] + 1 < summary_df.shape[1]:
+        r, c = hits[0]
+        return str(summary_df.iat[r, c + 1])
+    return None
+
+# 🏷 "km+mmm" labels for every chainage at once; values that aren't numbers are shown as entered
+def chainage_labels(chainage):
+    metres = pd.to_numeric(chainage, errors='coerce').to_numpy(float)
+    numeric = np.isfinite(metres)
+    whole = np.trunc(np.where(numeric, metres, 0)).astype(np.int64)
+    return [
+        f"{km}+{m:03d}" if ok else str(raw)
+        for km, m, ok, raw in zip((whole // 1000).tolist(), (whole % 1000).tolist(), numeric.tolist(), chainage.tolist())
+    ]
+
+# 📄 Whole report pipeline, cached on its inputs so widget reruns reuse the rendered PDF and previews
+@st.cache_data(show_spinner=False, max_entries=4)
+def build_report(data_bytes, summary_bytes, contract_no_input, manual_summary):
+    data = load_input(data_bytes)
+
+    # Step 3: Contract Info
+    contract_no = contract_no_input
+    if summary_bytes:
+        summary_df = load_summary(summary_bytes)
+        contract_no = find_contract_no(summary_bytes) or contract_no
+
+    # Step 4: PDF Plot Generation (vector pages rendered in batches, merged into the report by pypdf)
+    # Rendered batches are spooled to a temp dir and only read back by the merge, so they are not all held in RAM
+    with tempfile.TemporaryDirectory() as page_dir:
+        part_paths = []
+
+        def spool_pdf(part_pdf):
+            path = os.path.join(page_dir, f"part_{len(part_paths):05d}.pdf")
+            with open(path, "wb") as f:
+                f.write(part_pdf)
+            part_paths.append(path)
+
+        if summary_bytes or manual_summary:
+            # A bare Figure is never registered with pyplot, so there is nothing to close even if a run fails
+            fig_summary = Figure(figsize=(11.7, 8.3))
+            ax_summary = fig_summary.subplots()
             ax_summary.axis('off')
-            if summary_file:
+            if summary_bytes:
                 table_data = summary_df.dropna(how='all').dropna(axis=1, how='all')
                 cell_text = table_data.astype(str).values.tolist()
             else:
@@ -175,93 +188,152 @@ if data_file and st.button("📊 Generate Cross Section Plots"):
             table.set_fontsize(8)
             table.scale(1, 1.5)
             fig_summary.suptitle("Project Summary", fontsize=12)
-            pdf.savefig(fig_summary)
-            plt.close(fig_summary)
+            spool_pdf(figure_to_pdf(fig_summary))
+
+        progress = st.progress(0, text="Generating plots...")
 
+        # Geometry for all complete rows in one vectorized pass; rows with an unusable slope are skipped up front
+        plot_data = data[data.notna().all(axis=1)]
+        fw = plot_data['Finished Roadway Width'].to_numpy(float)
+        fh = plot_data['Finished Vertical Height'].to_numpy(float)
+        ow = plot_data['Original Roadway Width'].to_numpy(float)
+        angle_deg = pd.to_numeric(plot_data['Cutting slope'], errors='coerce').to_numpy(float)
+        drawable, finished, original, label_xy = cross_section_geometry(
+            fw, fh, ow, plot_data['Area Coefficient'].to_numpy(float), angle_deg
+        )
+        labels = np.array(chainage_labels(plot_data['Chainage']), dtype=object)
+        plot_inputs = [
+            values[1:]
+            for values in zip(drawable, labels, fw, fh, ow,
+                              plot_data['Area (m²)'].to_numpy(), finished, original, label_xy)
+            if values[0]
+        ]
+        skipped_chainages = labels[~drawable].tolist()
+
+        # Each page is independent: render them to PDF in worker processes, four plots to a page.
+        # Batches of up to 16 pages (fewer when that leaves CPUs idle) keep the fonts shared within each batch
         rows, cols = 2, 2
-        figsize = (11.7, 8.3)
-        fig, axs = plt.subplots(rows, cols, figsize=figsize)
-        axs = axs.flatten()
-        fig.suptitle(contract_no, fontsize=10, x=0.5, y=0.98)
+        page_size = rows * cols
+        pages = [plot_inputs[start:start + page_size] for start in range(0, len(plot_inputs), page_size)]
+        preview_counts = [min(page_size, max(0, 40 - start)) for start in range(0, len(plot_inputs), page_size)]
+        # Checked before the pages go to the workers: a summary-only PDF would carry no total volume at all
+        if not pages:
+            raise ValueError("No complete chainage rows to plot.")
+
+        # The last page carries the total volume, so the PDF reports it without a total row in the data
+        footers = [None] * len(pages)
+        footers[-1] = f"Total Volume = {data['Volume (m³)'].round(3).sum():,.3f} m³"
+        jobs = list(zip(pages, preview_counts, footers))
+        batch_size = min(16, max(1, -(-len(jobs) // (os.cpu_count() or 1))))
+        batches = [jobs[start:start + batch_size] for start in range(0, len(jobs), batch_size)]
 
-        plot_count = 0
         preview_imgs = []
-        progress = st.progress(0, text="Generating plots...")
-        step = 1 / max(len(data), 1)
-
-        for idx, row in data.iterrows():
-            if row.notna().all():
-                ax = axs[plot_count % (rows * cols)]
-                plot_chainage_subplot(row, ax)
-
-                if plot_count < 40:
-                    buf = io.BytesIO()
-                    fig_preview, ax_preview = plt.subplots()
-                    plot_chainage_subplot(row, ax_preview)
-                    fig_preview.savefig(buf, format='png')
-                    plt.close(fig_preview)
-                    preview_imgs.append(buf.getvalue())
-
-                plot_count += 1
-                progress.progress(min(int(plot_count * step * 100), 100), text="Processing...")
-
-                if plot_count % (rows * cols) == 0:
-                    pdf.savefig(fig)
-                    plt.close(fig)
-                    fig, axs = plt.subplots(rows, cols, figsize=figsize)
-                    axs = axs.flatten()
-
-        if plot_count % (rows * cols) != 0:
-            for i in range(plot_count % (rows * cols), rows * cols):
-                fig.delaxes(axs[i])
-            pdf.savefig(fig)
-            plt.close(fig)
-
-        pdf.close()
-        progress.progress(100, text="Done!")
+        # Each progress call is a websocket message, so the bar moves at most ~100 times however long the report is
+        progress_every = max(1, len(batches) // 100)
+        with ProcessPoolExecutor() as executor:
+            results = executor.map(render_pages_pdf, batches, [contract_no] * len(batches))
+            for batch_number, (part_pdf, previews) in enumerate(results, 1):
+                spool_pdf(part_pdf)
+                preview_imgs.extend(previews)
+                if batch_number % progress_every == 0:
+                    progress.progress(int(batch_number / len(batches) * 100), text="Processing...")
+
+        writer = PdfWriter()
+        for path in part_paths:
+            writer.append(path)
+        # Each batch embeds its own copy of the glyphs; keep one of each
+        writer.compress_identical_objects()
+        # Written straight to disk and read back once, instead of an in-memory buffer plus its getvalue() copy
+        pdf_path = os.path.join(page_dir, "report.pdf")
+        with open(pdf_path, "wb") as f:
+            writer.write(f)
+        with open(pdf_path, "rb") as f:
+            pdf_bytes = f.read()
+    progress.progress(100, text="Done!")
+
+    return pdf_bytes, preview_imgs, skipped_chainages
+
+# 📊 Volume calculation sheet, cached like the report so the download fragment only ever reads finished bytes
+@st.cache_data(show_spinner=False, max_entries=4)
+def build_volume_sheet(data_bytes):
+    data = load_input(data_bytes)
+    minimal_df = pd.DataFrame({
+        "S.No": data["S.No"],
+        "Chainage": data["Chainage"],
+        "Area": data["Area (m²)"].round(3),
+        "Volume": data["Volume (m³)"].round(3)
+    })
+
+    # Total row only exists in the export; blank cells stay NaN so the numeric columns keep their dtype
+    total_row = pd.DataFrame({
+        "S.No": ["Total"],
+        "Chainage": [np.nan],
+        "Area": [np.nan],
+        "Volume": [round(data["Volume (m³)"].round(3).sum(), 3)]
+    })
+    minimal_df = pd.concat([minimal_df, total_row], ignore_index=True)
+
+    excel_buffer_min = io.BytesIO()
+    # Pinned to xlsxwriter rather than whichever writer pandas finds first; constant_memory is left off because
+    # pandas writes column by column and that mode silently drops cells behind the current row
+    with pd.ExcelWriter(excel_buffer_min, engine='xlsxwriter') as writer:
+        minimal_df.to_excel(writer, index=False, sheet_name='Volume Calculation Sheet')
+    return excel_buffer_min.getvalue()
+
+# 🧩 Fragments: interacting with these reruns only the fragment, not the report pipeline
+@st.fragment
+def download_section(pdf_bytes, xlsx_bytes):
+    st.download_button(
+        label="📥 Download PDF with Plots",
+        data=pdf_bytes,
+        file_name="CrossSection_Plots.pdf",
+        mime="application/pdf"
+    )
+    st.download_button(
+        label="📥 Download Volume Calculation Sheet (S.No, Chainage, Area, Volume)",
+        data=xlsx_bytes,
+        file_name="Volume_Calculation_Sheet.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
+
+@st.fragment
+def show_previews(preview_imgs):
+    st.subheader("🔍 Preview of Plots (up to 40 shown)")
+    # One image element for the whole gallery instead of one per preview
+    st.image(preview_imgs, width=300)
 
-        st.success("✅ Plots generated successfully!")
-        st.download_button(
-            label="📥 Download PDF with Plots",
-            data=pdf_buffer.getvalue(),
-            file_name="CrossSection_Plots.pdf",
-            mime="application/pdf"
+# ✅ Main Generate Button
+if data_file and st.button("📊 Generate Cross Section Plots"):
+    try:
+        # Upload buffers are copied out once; every read and cache key below works on these bytes
+        data_bytes = data_file.getvalue()
+        summary_bytes = summary_file.getvalue() if summary_file else None
+
+        # Step 1 & 2: Read data, Area and Volume Calculation
+        data = load_input(data_bytes)
+
+        # Step 3 & 4: Contract Info, PDF Plot Generation
+        pdf_bytes, preview_imgs, skipped_chainages = build_report(
+            data_bytes,
+            summary_bytes,
+            contract_no_input,
+            manual_summary,
         )
+        # Step 5: Volume Calculation Sheet (Excel)
+        xlsx_bytes = build_volume_sheet(data_bytes)
+
+        total_volume = data["Volume (m³)"].round(3).sum()
+
+        st.success("✅ Plots generated successfully!")
+        if skipped_chainages:
+            shown = ", ".join(skipped_chainages[:20]) + (" ..." if len(skipped_chainages) > 20 else "")
+            st.warning(f"⚠️ Skipped {len(skipped_chainages)} row(s) with a zero or non-numeric cutting slope (Chainage: {shown})")
+        # Same three decimals as the PDF footer and the Excel total row
+        st.metric("Total Volume (m³)", f"{total_volume:,.3f}")
+        download_section(pdf_bytes, xlsx_bytes)
 
         if preview_imgs:
-            st.subheader("🔍 Preview of Plots (up to 40 shown)")
-            cols = st.columns(4)
-            for i, img in enumerate(preview_imgs):
-                with cols[i % 4]:
-                    st.image(img, use_column_width=True)
-
-        # Step 5: Generate Volume Calculation Sheet (Excel)
-        minimal_df = pd.DataFrame({
-            "S.No": data["S.No"],
-            "Chainage": data["Chainage"],
-            "Area": data["Area (m²)"].round(3),
-            "Volume": data["Volume (m³)"].round(3)
-        })
-
-        total_volume = minimal_df["Volume"].sum()
-        total_row = {
-            "S.No": "Total",
-            "Chainage": "",
-            "Area": "",
-            "Volume": round(total_volume, 3)
-        }
-        minimal_df = pd.concat([minimal_df, pd.DataFrame([total_row])], ignore_index=True)
-
-        excel_buffer_min = io.BytesIO()
-        with pd.ExcelWriter(excel_buffer_min) as writer:
-            minimal_df.to_excel(writer, index=False, sheet_name='Volume Calculation Sheet')
-
-        st.download_button(
-            label="📥 Download Volume Calculation Sheet (S.No, Chainage, Area, Volume)",
-            data=excel_buffer_min.getvalue(),
-            file_name="Volume_Calculation_Sheet.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+            show_previews(preview_imgs)
 
     except Exception as e:
         st.error(f"❌ Error: {e}")
@@ -0,0 +1,132 @@
+import io
+
+import matplotlib
+import numpy as np
+from PIL import Image
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
+
+# Kept free of Streamlit and pyplot so the functions can run in worker processes
+
+# Set here rather than in app.py: worker processes only inherit the parent's rcParams under fork
+matplotlib.rcParams["text.hinting"] = "no_hinting"
+
+
+# 📐 Geometry for every row at once: drawable mask plus (n, 4, 2) vertex arrays
+def cross_section_geometry(fw, fh, ow, ac, angle_deg):
+    drawable = ~np.isnan(angle_deg) & (angle_deg != 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = 1 / np.tan(np.radians(angle_deg))
+
+    h1 = (ac - 0.5) * 2 * fh
+
+    x1 = -fw / 2
+    x3 = fw / 2
+    x4 = fw / 2 + slope * fh
+    x6 = x1 + ow
+    x7 = x6 + h1 * slope
+    zero = np.zeros_like(fw)
+
+    finished = np.stack([np.column_stack([x1, zero, x3, x4]), np.column_stack([zero, zero, zero, fh])], axis=-1)
+    original = np.stack([np.column_stack([x1, x6, x7, x4]), np.column_stack([zero, zero, h1, fh])], axis=-1)
+    label_xy = np.column_stack([(x3 + x7) / 2, (fh + h1) / 2])
+    return drawable, finished, original, label_xy
+
+# 🖼 Plotting function
+def plot_chainage_subplot(chainage_label, fw, fh, ow, area, finished, original, label_xy, ax):
+    outline = np.concatenate([original, finished[::-1]])
+
+          # Plot lines
+    ax.plot(finished[:, 0], finished[:, 1], color="green", linewidth=2, label=f"Finished Roadway Width(FR): {fw:.2f} m")
+    ax.plot(original[:, 0], original[:, 1], color="red", linestyle="--", linewidth=2, label=f"Original Roadway Width(OR): {ow:.2f} m")
+    ax.fill(outline[:, 0], outline[:, 1], facecolor=(0.5, 0.5, 0.5, 0.3), edgecolor='black', linewidth=0.5)
+
+    # Add area as a text label inside plot
+    ax.text(*label_xy, f"Area = {area:.2f} m²", fontsize=8, ha='center')
+
+    # Draw horizontal axis
+    ax.axhline(0, color='black', linestyle=':')
+
+    # Add custom height label in legend
+    height_proxy = Line2D([0], [0], color='white', label=f"Height: {fh:.2f} m")
+    handles, labels = ax.get_legend_handles_labels()
+    ax.legend(handles + [height_proxy], labels + [height_proxy.get_label()], fontsize=6, loc='upper left')
+
+    ax.set_title(f"Chainage {chainage_label}", fontsize=9)
+    ax.set_xlabel("Roadway Width", fontsize=6)
+    ax.set_ylabel("Height", fontsize=6)
+    ax.grid(True, linestyle='--', linewidth=0.3)
+
+# 🧾 Rasterize a figure once to an RGB image for the previews (JPEG has no alpha channel)
+def canvas_rgb(canvas):
+    canvas.draw()
+    return Image.fromarray(np.asarray(canvas.buffer_rgba())[..., :3])
+
+# One vector PDF page; savefig switches to the PDF backend and puts the figure's own canvas back afterwards
+def figure_to_pdf(fig):
+    buf = io.BytesIO()
+    fig.savefig(buf, format='pdf')
+    return buf.getvalue()
+
+# Previews are only ever shown in the browser, so lossy JPEG keeps the payload small
+def jpeg_bytes(image, dpi):
+    buf = io.BytesIO()
+    image.save(buf, format='jpeg', dpi=(dpi, dpi), quality=70, optimize=True)
+    return buf.getvalue()
+
+# 🔍 Preview helper: cut one subplot out of the page's already-rendered pixels instead of drawing it again
+def crop_axes_jpeg(fig, ax, page_image, dpi=72):
+    x0, y0, x1, y1 = ax.get_tightbbox(fig.canvas.get_renderer()).extents
+    # Pad sideways and above only (the next row's title sits right below); display y grows upwards, image y downwards
+    pad_x, pad_top = 0.1 * fig.dpi, 0.05 * fig.dpi
+    box = (
+        max(0, int(x0 - pad_x)), max(0, int(page_image.height - y1 - pad_top)),
+        min(page_image.width, int(x1 + pad_x)), min(page_image.height, int(page_image.height - y0)),
+    )
+    preview = page_image.crop(box)
+    scale = dpi / fig.dpi
+    preview = preview.resize((round(preview.width * scale), round(preview.height * scale)), Image.LANCZOS)
+    return jpeg_bytes(preview, dpi)
+
+# 🧵 Worker: a batch of 2x2 pages -> (one PDF holding the batch, preview JPEGs)
+# Each worker process keeps one page Figure, and the canvas holding its Agg renderer, and clears it between pages.
+_page_fig = None
+_page_canvas = None
+_page_axs = None
+_page_footer = None
+
+def draw_page(page_rows, title, preview_count, footer=None):
+    global _page_fig, _page_canvas, _page_axs, _page_footer
+    if _page_fig is None:
+        _page_fig = Figure(figsize=(11.7, 8.3), dpi=150)
+        _page_canvas = FigureCanvasAgg(_page_fig)
+        _page_axs = _page_fig.subplots(2, 2).flatten()
+        _page_footer = _page_fig.text(0.98, 0.01, "", fontsize=9, ha='right', va='bottom')
+
+    for i, ax in enumerate(_page_axs):
+        ax.cla()
+        # Unused slots on the last page are hidden rather than deleted so the Figure stays reusable
+        ax.set_visible(i < len(page_rows))
+        if i < len(page_rows):
+            plot_chainage_subplot(*page_rows[i], ax)
+    _page_fig.suptitle(title, fontsize=10, x=0.5, y=0.98)
+    _page_footer.set_text(footer or "")
+
+    # Only the pages that carry previews are rasterized at all
+    previews = []
+    if preview_count > 0:
+        page_image = canvas_rgb(_page_canvas)
+        previews = [crop_axes_jpeg(_page_fig, ax, page_image) for ax in _page_axs[:min(preview_count, len(page_rows))]]
+    return previews
+
+# A batch shares one PdfPages document, so its pages share one embedded copy of the fonts
+def render_pages_pdf(batch, title):
+    buf = io.BytesIO()
+    previews = []
+    with PdfPages(buf) as pdf:
+        for page_rows, preview_count, footer in batch:
+            previews.extend(draw_page(page_rows, title, preview_count, footer))
+            pdf.savefig(_page_fig)
+    return buf.getvalue(), previews